@@ -4,8 +4,54 @@ import pandas as pd
 import numpy as np
 from pathlib import Path
 import argparse
-from typing import Dict, List, Optional, Set, Union
+import functools
+import importlib.util
+from typing import Callable, Dict, List, Optional, Tuple, Union
 import json
+import re
+
+# Numba is optional and only used to speed up very large timelines. Importing
+# it is slow, so it's imported on first use by compile_outcome_rows_kernel.
+NUMBA_AVAILABLE = importlib.util.find_spec("numba") is not None
+numba = None
+
+# Matches condition descriptions mentioning diabetes ("diabetes" or "diabetic")
+DIABETES_DESCRIPTION_PATTERN = re.compile(r"diabet(?:es|ic)", flags=re.IGNORECASE)
+
+# LOINC codes for vital signs. BMI: 39156-5, Systolic BP: 8480-6, Diastolic BP: 8462-4
+VITAL_CODES = ["39156-5", "8480-6", "8462-4"]
+
+# Buffer size for output files; the default 8 KiB means many more write syscalls
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Timelines longer than this use the Numba kernel (when installed) to pick
+# pre/post-medication rows instead of pandas groupby
+NUMBA_MIN_TIMELINE_ROWS = 1_000_000
+
+# Columns (and their types) read from each dataset CSV; everything else in
+# the raw files is unused downstream, so it's never parsed
+DATASET_SCHEMAS = {
+    "patients.csv": {
+        "usecols": ["patient", "gender", "race", "ethnicity"],
+        "dtype": {"patient": "string", "gender": "string", "race": "string", "ethnicity": "string"},
+    },
+    "conditions.csv": {
+        "usecols": ["patient", "code", "description", "start"],
+        "dtype": {"patient": "string", "code": "string", "description": "string", "start": "string"},
+    },
+    "medications.csv": {
+        "usecols": ["patient", "code", "description", "start", "stop", "reasondescription"],
+        "dtype": {"patient": "string", "code": "string", "description": "string", "reasondescription": "string"},
+        "parse_dates": ["start", "stop"],
+        "date_format": "ISO8601",
+    },
+    "observations.csv": {
+        "usecols": ["patient", "code", "description", "date", "value", "units"],
+        "dtype": {"patient": "string", "code": "string", "description": "string", "units": "string"},
+        "parse_dates": ["date"],
+        "date_format": "ISO8601",
+    },
+}
 
 def parse_all_args(args: Optional[List[str]] = None) -> argparse.Namespace:
     """Parse command line arguments for data preparation.
@@ -53,20 +99,41 @@ def parse_all_args(args: Optional[List[str]] = None) -> argparse.Namespace:
         action="store_true",
         help="Include vital signs like BMI and blood pressure for diabetic patients"
     )
+    parser.add_argument(
+        "--output_format", 
+        type=str, 
+        choices=["csv", "parquet"],
+        default="csv",
+        help="File format for processed data files (parquet requires pyarrow)"
+    )
     
     return parser.parse_args(args)
 
-def load_dataset(data_dir: Union[str, Path]) -> Dict[str, pd.DataFrame]:
+def load_dataset(
+    data_dir: Union[str, Path],
+    files: Optional[List[str]] = None,
+    patients: Optional[pd.Index] = None,
+    observation_codes: Optional[List[str]] = None,
+    chunksize: int = 200_000
+) -> Dict[str, pd.DataFrame]:
     """Load the Siyeh dataset CSV files.
     
+    When `patients` is given, files are streamed in chunks and only rows for
+    those patients are kept, so peak memory is bounded by one chunk rather
+    than the whole file.
+    
     Args:
         data_dir: Directory containing the dataset CSV files
+        files: CSV files to load. If None, all required files are loaded.
+        patients: Patient IDs to keep. If None, all rows are loaded.
+        observation_codes: LOINC codes to keep from observations.csv when streaming
+        chunksize: Number of rows per chunk when streaming
         
     Returns:
         Dictionary of dataframes for each CSV file
     """
     data_dir = Path(data_dir)
-    required_files = ["patients.csv", "conditions.csv", "medications.csv", "observations.csv"]
+    required_files = files or ["patients.csv", "conditions.csv", "medications.csv", "observations.csv"]
     
     dataset = {}
     for file in required_files:
@@ -75,11 +142,62 @@ def load_dataset(data_dir: Union[str, Path]) -> Dict[str, pd.DataFrame]:
             raise FileNotFoundError(f"Required file {file} not found in {data_dir}")
         
         print(f"Loading {file}...")
-        dataset[file.split('.')[0]] = pd.read_csv(file_path)
+        if patients is None:
+            dataset[file.split('.')[0]] = pd.read_csv(file_path, low_memory=False, **DATASET_SCHEMAS[file])
+            continue
+        
+        # Stream the file and filter each chunk
+        filtered_chunks = []
+        for chunk in pd.read_csv(file_path, chunksize=chunksize, low_memory=False, **DATASET_SCHEMAS[file]):
+            mask = chunk["patient"].isin(patients)
+            if file == "observations.csv" and observation_codes is not None:
+                mask &= chunk["code"].isin(observation_codes)
+            filtered_chunks.append(chunk[mask])
+        dataset[file.split('.')[0]] = pd.concat(filtered_chunks, ignore_index=True)
+    
+    # Chunks infer the value column's dtype separately, so a file with text
+    # values in some chunks would mix strings and floats; coerce it once here
+    if "observations" in dataset:
+        dataset["observations"]["value"] = pd.to_numeric(dataset["observations"]["value"], errors="coerce")
         
     return dataset
 
-def identify_diabetic_patients(conditions_df: pd.DataFrame, diabetes_codes: List[str]) -> Set[str]:
+def code_sort_key(code: str) -> Tuple[int, int, str]:
+    """Sort key putting numeric codes first, in numeric order, then the rest.
+    
+    Args:
+        code: Medical code, e.g. "860975" or "4548-4"
+        
+    Returns:
+        Key tuple for sorted()
+    """
+    if code.isdigit():
+        return (0, int(code), "")
+    return (1, 0, code)
+
+def categorize_identifiers(dataset: Dict[str, pd.DataFrame]) -> None:
+    """Convert patient IDs and codes to categoricals in place.
+    
+    Filters then compare small integer codes instead of hashing strings. All
+    tables share one patient dtype so merges on "patient" stay categorical.
+    
+    Args:
+        dataset: Dictionary of dataframes
+    """
+    patient_ids = pd.Index([])
+    for df in dataset.values():
+        patient_ids = patient_ids.union(df["patient"].dropna().unique())
+    patient_dtype = pd.CategoricalDtype(categories=patient_ids)
+    
+    for name, df in dataset.items():
+        df["patient"] = df["patient"].astype(patient_dtype)
+        if "code" in df.columns:
+            # Order numeric codes (RxNorm, SNOMED) by value rather than as
+            # strings, so groupby output keeps the order integer codes had
+            codes = sorted(df["code"].dropna().unique(), key=code_sort_key)
+            df["code"] = df["code"].astype(pd.CategoricalDtype(categories=codes))
+
+def identify_diabetic_patients(conditions_df: pd.DataFrame, diabetes_codes: List[str]) -> pd.Index:
     """Identify patients with diabetes based on condition codes.
     
     Args:
@@ -87,67 +205,56 @@ def identify_diabetic_patients(conditions_df: pd.DataFrame, diabetes_codes: List
         diabetes_codes: List of SNOMED CT codes for diabetes
         
     Returns:
-        Set of patient IDs with diabetes
+        Sorted index of patient IDs with diabetes
     """
     # First approach: Use the provided diabetes codes
-    diabetes_conditions = conditions_df[conditions_df["code"].isin(diabetes_codes)]
-    diabetic_patients = set(diabetes_conditions["patient"].unique())
+    codes_mask = conditions_df["code"].isin(set(diabetes_codes))
     
     # Second approach: Use text matching for additional cases
-    diabetes_desc_conditions = conditions_df[conditions_df["description"].str.contains("diabetes|diabetic", case=False, na=False)]
-    diabetic_patients_desc = set(diabetes_desc_conditions["patient"].unique())
+    desc_mask = conditions_df["description"].str.contains(DIABETES_DESCRIPTION_PATTERN, na=False)
     
-    # Combine both approaches
-    all_diabetic_patients = diabetic_patients.union(diabetic_patients_desc)
+    # Combine both approaches in a single selection
+    # Return an Index rather than a set so the later isin() filters can use it
+    # directly instead of converting it on every call
+    all_diabetic_patients = pd.Index(
+        conditions_df.loc[codes_mask | desc_mask, "patient"].dropna().unique(),
+        name="patient"
+    ).sort_values()
     
     print(f"Identified {len(all_diabetic_patients)} patients with diabetes")
-    print(f"  - {len(diabetic_patients)} patients identified by code")
-    print(f"  - {len(diabetic_patients_desc)} patients identified by description")
+    print(f"  - {conditions_df.loc[codes_mask, 'patient'].nunique()} patients identified by code")
+    print(f"  - {conditions_df.loc[desc_mask, 'patient'].nunique()} patients identified by description")
     
     return all_diabetic_patients
 
 def filter_dataset_for_diabetic_patients(
     dataset: Dict[str, pd.DataFrame], 
-    diabetic_patients: Set[str],
+    diabetic_patients: pd.Index,
     include_comorbidities: bool = False
 ) -> Dict[str, pd.DataFrame]:
     """Filter the dataset to include only diabetic patients.
     
     Args:
         dataset: Dictionary of dataframes
-        diabetic_patients: Set of patient IDs with diabetes
+        diabetic_patients: Index of patient IDs with diabetes
         include_comorbidities: Whether to include all conditions or just diabetes
         
     Returns:
         Filtered dataset
     """
-    filtered_dataset = {}
-    
-    # Filter patients
-    filtered_dataset["patients"] = dataset["patients"][
-        dataset["patients"]["patient"].isin(diabetic_patients)
-    ]
+    # Filter every table by patient in a single pass per table
+    filtered_dataset = {
+        name: df.loc[df["patient"].isin(diabetic_patients)]
+        for name, df in dataset.items()
+    }
     
-    # Filter conditions (either all conditions for diabetic patients or just diabetes)
-    if include_comorbidities:
-        filtered_dataset["conditions"] = dataset["conditions"][
-            dataset["conditions"]["patient"].isin(diabetic_patients)
+    # Keep just diabetes conditions unless comorbidities are requested; the
+    # code filter runs on the already-filtered, smaller table
+    if not include_comorbidities:
+        conditions = filtered_dataset["conditions"]
+        filtered_dataset["conditions"] = conditions[
+            conditions["code"].isin(["44054006", "46635009"])
         ]
-    else:
-        filtered_dataset["conditions"] = dataset["conditions"][
-            dataset["conditions"]["patient"].isin(diabetic_patients) & 
-            dataset["conditions"]["code"].isin(["44054006", "46635009"])
-        ]
-    
-    # Filter medications
-    filtered_dataset["medications"] = dataset["medications"][
-        dataset["medications"]["patient"].isin(diabetic_patients)
-    ]
-    
-    # Filter observations
-    filtered_dataset["observations"] = dataset["observations"][
-        dataset["observations"]["patient"].isin(diabetic_patients)
-    ]
     
     return filtered_dataset
 
@@ -167,16 +274,13 @@ def filter_relevant_observations(
         Filtered observations DataFrame
     """
     # Always include glucose measurements
-    relevant_obs = observations_df[observations_df["code"].isin(glucose_codes)]
+    codes = set(glucose_codes)
     
     # Optionally include vital signs
     if include_vitals:
-        # BMI code: 39156-5, Systolic BP: 8480-6, Diastolic BP: 8462-4
-        vital_codes = ["39156-5", "8480-6", "8462-4"]
-        vitals_obs = observations_df[observations_df["code"].isin(vital_codes)]
-        relevant_obs = pd.concat([relevant_obs, vitals_obs])
+        codes.update(VITAL_CODES)
     
-    return relevant_obs
+    return observations_df[observations_df["code"].isin(codes)]
 
 def create_medication_periods(medications_df: pd.DataFrame) -> pd.DataFrame:
     """Create a DataFrame with medication periods for each patient.
@@ -188,8 +292,8 @@ def create_medication_periods(medications_df: pd.DataFrame) -> pd.DataFrame:
         DataFrame with medication periods
     """
     # Convert date columns to datetime
-    medications_df["start"] = pd.to_datetime(medications_df["start"])
-    medications_df["stop"] = pd.to_datetime(medications_df["stop"])
+    medications_df["start"] = pd.to_datetime(medications_df["start"], format="ISO8601", cache=True)
+    medications_df["stop"] = pd.to_datetime(medications_df["stop"], format="ISO8601", cache=True)
     
     # Fill missing stop dates with a future date
     medications_df["stop"] = medications_df["stop"].fillna(pd.Timestamp.max)
@@ -214,57 +318,126 @@ def create_observation_timeline(
         print("Warning: Empty observations or medications dataframe")
         return pd.DataFrame()
     
+    # Drop observations of patients without medications before parsing, since
+    # they can't appear in the timeline
+    med_patients = pd.Index(medication_periods_df["patient"].unique())
+    observations_df = observations_df[observations_df["patient"].isin(med_patients)].copy()
+    
     # Convert date column to datetime
-    observations_df["date"] = pd.to_datetime(observations_df["date"])
+    observations_df["date"] = pd.to_datetime(observations_df["date"], format="ISO8601", cache=True)
     
     # Convert value column to numeric
     observations_df["value"] = pd.to_numeric(observations_df["value"], errors="coerce")
     
-    # Initialize an empty list to store results
-    timeline_records = []
+    # Rename columns so observation and medication fields don't collide
+    obs = observations_df.rename(columns={
+        "code": "obs_code",
+        "description": "obs_description",
+        "date": "obs_date"
+    })[["patient", "obs_code", "obs_description", "obs_date", "value", "units"]]
+    meds = medication_periods_df.rename(columns={
+        "code": "med_code",
+        "description": "med_description",
+        "start": "med_start_date"
+    })[["patient", "med_code", "med_description", "med_start_date"]]
+
+    # Pair every observation with every medication of the same patient;
+    # patients with no medications drop out of the inner join
+    timeline_df = obs.merge(meds, on="patient", how="inner")
+
+    # Calculate days relative to medication start
+    timeline_df["days_relative"] = (timeline_df["obs_date"] - timeline_df["med_start_date"]).dt.days
+
+    timeline_df = timeline_df[[
+        "patient", "med_code", "med_description", "med_start_date",
+        "obs_code", "obs_description", "obs_date", "days_relative",
+        "value", "units"
+    ]]
+
+    return timeline_df
+
+def outcome_rows_kernel(
+    starts: np.ndarray,
+    ends: np.ndarray,
+    days: np.ndarray,
+    target_days: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Pick the pre- and post-medication row of each group.
     
-    # Process each patient
-    for patient in observations_df["patient"].unique():
-        patient_obs = observations_df[observations_df["patient"] == patient]
-        patient_meds = medication_periods_df[medication_periods_df["patient"] == patient]
+    Rows must be sorted by group, then by days_relative; group g spans
+    rows starts[g]:ends[g].
+    
+    Args:
+        starts: First row of each group
+        ends: One past the last row of each group
+        days: days_relative of each row
+        target_days: Preferred number of days after medication start
         
-        # Skip patients with no medications
-        if len(patient_meds) == 0:
-            continue
+    Returns:
+        Row positions of the last pre-medication (days <= 0) row and of the
+        post-medication (days > 0) row closest to target_days, or -1 if a
+        group has none
+    """
+    n_groups = len(starts)
+    pre_rows = np.full(n_groups, -1, dtype=np.int64)
+    post_rows = np.full(n_groups, -1, dtype=np.int64)
+    for g in numba.prange(n_groups):
+        best_diff = np.inf
+        for i in range(starts[g], ends[g]):
+            if days[i] <= 0:
+                pre_rows[g] = i
+            elif days[i] > 0 and abs(days[i] - target_days) < best_diff:
+                best_diff = abs(days[i] - target_days)
+                post_rows[g] = i
+    return pre_rows, post_rows
+
+@functools.lru_cache(maxsize=None)
+def compile_outcome_rows_kernel() -> Callable:
+    """Import Numba and JIT-compile outcome_rows_kernel, once per process.
+    
+    Returns:
+        Compiled version of outcome_rows_kernel
+    """
+    global numba
+    import numba
+    return numba.njit(parallel=True, cache=True)(outcome_rows_kernel)
+
+def select_outcome_rows_numba(
+    timeline_df: pd.DataFrame,
+    keys: List[str],
+    target_days: int
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Select pre- and post-medication rows per group with the Numba kernel.
+    
+    Picks the same rows as the pandas groupby path in
+    create_patient_medication_outcomes, but in a single compiled pass.
+    
+    Args:
+        timeline_df: DataFrame with observation timeline
+        keys: Columns identifying a (patient, medication, observation) group
+        target_days: Preferred number of days after medication start
         
-        # For each medication
-        for _, med_row in patient_meds.iterrows():
-            med_start = med_row["start"]
-            med_code = med_row["code"]
-            med_desc = med_row["description"]
-            
-            # For each observation
-            for _, obs_row in patient_obs.iterrows():
-                obs_date = obs_row["date"]
-                
-                # Calculate days relative to medication start
-                days_relative = (obs_date - med_start).days
-                
-                # Create a record
-                record = {
-                    "patient": patient,
-                    "med_code": med_code,
-                    "med_description": med_desc,
-                    "med_start_date": med_start,
-                    "obs_code": obs_row["code"],
-                    "obs_description": obs_row["description"],
-                    "obs_date": obs_date,
-                    "days_relative": days_relative,
-                    "value": obs_row["value"],
-                    "units": obs_row["units"]
-                }
-                
-                timeline_records.append(record)
-    
-    # Create DataFrame from records
-    timeline_df = pd.DataFrame(timeline_records)
+    Returns:
+        Tuple of (pre-medication rows, post-medication rows), one row per group
+    """
+    group_ids = timeline_df.groupby(keys, observed=True, sort=False).ngroup().to_numpy()
+    days = timeline_df["days_relative"].to_numpy(dtype=float)
     
-    return timeline_df
+    # Sort by group, then days_relative; lexsort is stable so ties keep timeline order
+    order = np.lexsort((days, group_ids))
+    order = order[group_ids[order] >= 0]  # Drop rows with missing keys
+    sorted_ids = group_ids[order]
+    
+    boundaries = np.flatnonzero(sorted_ids[1:] != sorted_ids[:-1]) + 1
+    starts = np.concatenate(([0], boundaries)).astype(np.int64)
+    ends = np.concatenate((boundaries, [len(order)])).astype(np.int64)
+    
+    kernel = compile_outcome_rows_kernel()
+    pre_rows, post_rows = kernel(starts, ends, days[order], float(target_days))
+    
+    pre_med = timeline_df.iloc[order[pre_rows[pre_rows >= 0]]]
+    post_med = timeline_df.iloc[order[post_rows[post_rows >= 0]]]
+    return pre_med, post_med
 
 def create_patient_medication_outcomes(timeline_df: pd.DataFrame) -> pd.DataFrame:
     """Create a summary of medication outcomes for each patient.
@@ -283,102 +456,109 @@ def create_patient_medication_outcomes(timeline_df: pd.DataFrame) -> pd.DataFram
     # Ensure value column is numeric
     timeline_df["value"] = pd.to_numeric(timeline_df["value"], errors="coerce")
     
-    # Initialize an empty list to store results
-    outcome_records = []
-    
-    # Group by patient and medication
-    for (patient, med_code, med_desc), group in timeline_df.groupby(["patient", "med_code", "med_description"]):
-        # Group observations by type
-        for obs_code, obs_group in group.groupby("obs_code"):
-            # Skip if less than 2 observations
-            if len(obs_group) < 2:
-                continue
-                
-            # Get the observation description
-            obs_desc = obs_group["obs_description"].iloc[0]
-            units = obs_group["units"].iloc[0]
-            
-            # Sort by days_relative
-            obs_group = obs_group.sort_values("days_relative")
-            
-            # Get pre-medication values (days_relative <= 0)
-            pre_med = obs_group[obs_group["days_relative"] <= 0]
-            if len(pre_med) > 0:
-                pre_value = pre_med.iloc[-1]["value"]  # Most recent pre-medication value
-                pre_date = pre_med.iloc[-1]["obs_date"]
-            else:
-                continue  # Skip if no pre-medication values
-            
-            # Get post-medication values (days_relative > 0)
-            post_med = obs_group[obs_group["days_relative"] > 0]
-            if len(post_med) > 0:
-                # Find observations around 3-6 months after medication start
-                target_days = 180  # ~6 months
-                post_med["days_diff"] = abs(post_med["days_relative"] - target_days)
-                closest_idx = post_med["days_diff"].idxmin()
-                post_value = post_med.loc[closest_idx, "value"]
-                post_date = post_med.loc[closest_idx, "obs_date"]
-                actual_days = post_med.loc[closest_idx, "days_relative"]
-            else:
-                continue  # Skip if no post-medication values
-            
-            # Calculate change
-            try:
-                change = float(post_value) - float(pre_value)
-                percent_change = (change / float(pre_value)) * 100 if float(pre_value) != 0 else np.nan
-            except (ValueError, TypeError):
-                print(f"Warning: Could not calculate change for values {pre_value} and {post_value}")
-                change = np.nan
-                percent_change = np.nan
-            
-            # Create a record
-            record = {
-                "patient": patient,
-                "med_code": med_code,
-                "med_description": med_desc,
-                "obs_code": obs_code,
-                "obs_description": obs_desc,
-                "pre_value": pre_value,
-                "post_value": post_value,
-                "change": change,
-                "percent_change": percent_change,
-                "pre_date": pre_date,
-                "post_date": post_date,
-                "days_between": actual_days,
-                "units": units
-            }
-            
-            outcome_records.append(record)
-    
-    # Create DataFrame from records
-    outcomes_df = pd.DataFrame(outcome_records)
+    keys = ["patient", "med_code", "med_description", "obs_code"]
+    
+    target_days = 180  # ~6 months
+    if NUMBA_AVAILABLE and len(timeline_df) > NUMBA_MIN_TIMELINE_ROWS:
+        pre_med, post_med = select_outcome_rows_numba(timeline_df, keys, target_days)
+    else:
+        # Sort by days_relative once; a stable sort keeps ties in timeline order
+        timeline_df = timeline_df.sort_values("days_relative", kind="stable")
+        
+        # Get pre-medication values (days_relative <= 0): the most recent one per group
+        pre_med = timeline_df[timeline_df["days_relative"] <= 0]
+        pre_med = pre_med.groupby(keys, observed=True).tail(1)
+        
+        # Get post-medication values (days_relative > 0): the one closest to
+        # ~6 months after medication start per group
+        post_med = timeline_df[timeline_df["days_relative"] > 0].copy()
+        post_med["days_diff"] = (post_med["days_relative"] - target_days).abs()
+        post_med = post_med.loc[post_med.groupby(keys, observed=True)["days_diff"].idxmin()]
+    
+    pre_med = pre_med[
+        keys + ["obs_description", "units", "value", "obs_date"]
+    ].rename(columns={"value": "pre_value", "obs_date": "pre_date"})
+    post_med = post_med[
+        keys + ["value", "obs_date", "days_relative"]
+    ].rename(columns={"value": "post_value", "obs_date": "post_date", "days_relative": "days_between"})
+    
+    # Keep only groups with both a pre- and a post-medication value, which
+    # also guarantees at least 2 observations per group
+    outcomes_df = pre_med.merge(post_med, on=keys, how="inner")
+    
+    # Calculate change; values are already numeric (or NaN) from pd.to_numeric
+    pre_values = outcomes_df["pre_value"].to_numpy(dtype=float)
+    change = outcomes_df["post_value"].to_numpy(dtype=float) - pre_values
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percent_change = np.where(pre_values != 0, change / pre_values * 100, np.nan)
+    outcomes_df["change"] = change
+    outcomes_df["percent_change"] = percent_change
+    
+    outcomes_df = outcomes_df.sort_values(keys, ignore_index=True)[[
+        "patient", "med_code", "med_description", "obs_code", "obs_description",
+        "pre_value", "post_value", "change", "percent_change",
+        "pre_date", "post_date", "days_between", "units"
+    ]]
     
     return outcomes_df
 
+def save_dataframe(
+    df: pd.DataFrame,
+    output_dir: Path,
+    name: str,
+    output_format: str = "csv"
+) -> None:
+    """Save a DataFrame as CSV or zstd-compressed Parquet.
+    
+    Args:
+        df: DataFrame to save
+        output_dir: Directory to save the file in
+        name: File name without extension
+        output_format: Either "csv" or "parquet"
+    """
+    output_path = output_dir / f"{name}.{output_format}"
+    
+    # Write to a temporary file first so a failed write (e.g. a column pyarrow
+    # can't convert) never leaves an empty or truncated output file behind
+    temp_path = output_path.with_name(f"{output_path.name}.tmp")
+    try:
+        if output_format == "parquet":
+            with open(temp_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                df.to_parquet(f, index=False, compression="zstd")
+        else:
+            with open(temp_path, "w", buffering=WRITE_BUFFER_SIZE, newline="") as f:
+                df.to_csv(f, index=False)
+        temp_path.replace(output_path)
+    except Exception:
+        temp_path.unlink(missing_ok=True)
+        raise
+
 def save_processed_data(
     filtered_dataset: Dict[str, pd.DataFrame],
     timeline_df: pd.DataFrame,
     outcomes_df: pd.DataFrame,
-    output_dir: Union[str, Path]
+    output_dir: Union[str, Path],
+    output_format: str = "csv"
 ) -> None:
-    """Save processed data to CSV files.
+    """Save processed data to CSV or Parquet files.
     
     Args:
         filtered_dataset: Dictionary of filtered dataframes
         timeline_df: DataFrame with observation timeline
         outcomes_df: DataFrame with medication outcomes
         output_dir: Directory to save processed data files
+        output_format: Either "csv" or "parquet"
     """
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
     
     # Save filtered datasets
     for name, df in filtered_dataset.items():
-        df.to_csv(output_dir / f"{name}_diabetic.csv", index=False)
+        save_dataframe(df, output_dir, f"{name}_diabetic", output_format)
     
     # Save timeline and outcomes
-    timeline_df.to_csv(output_dir / "observation_timeline.csv", index=False)
-    outcomes_df.to_csv(output_dir / "medication_outcomes.csv", index=False)
+    save_dataframe(timeline_df, output_dir, "observation_timeline", output_format)
+    save_dataframe(outcomes_df, output_dir, "medication_outcomes", output_format)
     
     # Create a summary of the dataset
     summary = {
@@ -397,7 +577,7 @@ def save_processed_data(
         summary["glucose_metrics_tracked"] = []
         summary["medications_analyzed"] = []
     
-    with open(output_dir / "dataset_summary.json", "w") as f:
+    with open(output_dir / "dataset_summary.json", "w", buffering=WRITE_BUFFER_SIZE) as f:
         json.dump(summary, f, indent=2)
     
     print(f"Processed data saved to {output_dir}")
@@ -412,12 +592,23 @@ def main(args: argparse.Namespace) -> None:
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    # Load dataset
-    dataset = load_dataset(args.data_dir)
+    # Load patients and conditions, which are needed to identify diabetic patients
+    dataset = load_dataset(args.data_dir, files=["patients.csv", "conditions.csv"])
     
     # Identify diabetic patients
     diabetic_patients = identify_diabetic_patients(dataset["conditions"], args.diabetes_codes)
     
+    # Stream the large tables, keeping only diabetic patients' rows and
+    # relevant observations
+    observation_codes = args.glucose_codes + (VITAL_CODES if args.include_vitals else [])
+    dataset.update(load_dataset(
+        args.data_dir,
+        files=["medications.csv", "observations.csv"],
+        patients=diabetic_patients,
+        observation_codes=observation_codes
+    ))
+    categorize_identifiers(dataset)
+    
     # Filter dataset for diabetic patients
     filtered_dataset = filter_dataset_for_diabetic_patients(
         dataset, 
@@ -442,7 +633,7 @@ def main(args: argparse.Namespace) -> None:
     outcomes_df = create_patient_medication_outcomes(timeline_df)
     
     # Save processed data
-    save_processed_data(filtered_dataset, timeline_df, outcomes_df, args.output_dir)
+    save_processed_data(filtered_dataset, timeline_df, outcomes_df, args.output_dir, args.output_format)
     
     # Print some statistics
     print(f"\nProcessed {len(diabetic_patients)} diabetic patients")
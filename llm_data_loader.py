@@ -4,8 +4,107 @@ import pandas as pd
 import numpy as np
 from pathlib import Path
 import argparse
-from typing import Dict, List, Optional, Union
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 import json
+from collections import defaultdict
+
+# Output is written in many small pieces, so buffer them in large blocks
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Lookup table of the bytes str.split() treats as whitespace, for counting
+# tokens in encoded output
+ASCII_WHITESPACE = np.zeros(256, dtype=bool)
+ASCII_WHITESPACE[list(b" \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f")] = True
+
+# pyarrow is optional; when it's installed, its multithreaded CSV parser is
+# used, and parsed CSVs are cached as Parquet next to the originals
+PYARROW_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+CSV_READ_OPTIONS = (
+    {"engine": "pyarrow"} if PYARROW_AVAILABLE else {"engine": "c", "low_memory": False}
+)
+PARQUET_CACHE_SUFFIX = ".cache.parquet"
+
+# Columns (and their types) read from each processed CSV. Identifiers and
+# descriptions repeat across many rows, so they're read as categoricals.
+# med_code stays numeric: timelines are listed in medication code order, and
+# as strings "1373463" would sort before "860975".
+PROCESSED_SCHEMAS = {
+    "patients_diabetic.csv": {
+        "usecols": ["patient", "gender", "race", "ethnicity"],
+        "dtype": {
+            "patient": "category",
+            "gender": "category",
+            "race": "category",
+            "ethnicity": "category",
+        },
+    },
+    "conditions_diabetic.csv": {
+        "usecols": ["patient", "code", "description", "start"],
+        "dtype": {
+            "patient": "category",
+            "code": "category",
+            "description": "category",
+            "start": "string",
+        },
+    },
+    "medications_diabetic.csv": {
+        "usecols": ["patient", "start", "description", "reasondescription"],
+        "dtype": {
+            "patient": "category",
+            "start": "string",
+            "description": "category",
+            "reasondescription": "category",
+        },
+    },
+    "observation_timeline.csv": {
+        "usecols": [
+            "patient",
+            "med_code",
+            "med_description",
+            "obs_code",
+            "obs_description",
+            "obs_date",
+            "days_relative",
+            "value",
+        ],
+        "dtype": {
+            "patient": "category",
+            "med_code": "Int64",
+            "med_description": "category",
+            "obs_code": "category",
+            "obs_description": "category",
+            "obs_date": "string",
+            "days_relative": "Int32",
+            "value": "float64",
+        },
+    },
+    "medication_outcomes.csv": {
+        "usecols": [
+            "patient",
+            "med_description",
+            "obs_code",
+            "obs_description",
+            "pre_value",
+            "post_value",
+            "change",
+            "percent_change",
+            "days_between",
+        ],
+        "dtype": {
+            "patient": "category",
+            "med_description": "category",
+            "obs_code": "category",
+            "obs_description": "category",
+            "pre_value": "float64",
+            "post_value": "float64",
+            "change": "float64",
+            "percent_change": "float64",
+            "days_between": "int32",
+        },
+    },
+}
 
 
 def parse_all_args(args: Optional[List[str]] = None) -> argparse.Namespace:
@@ -48,6 +147,128 @@ def parse_all_args(args: Optional[List[str]] = None) -> argparse.Namespace:
     return parser.parse_args(args)
 
 
+def downcast_integers(df: pd.DataFrame) -> pd.DataFrame:
+    """Store integer columns in the narrowest type that holds their values.
+
+    Args:
+        df: DataFrame to downcast in place
+
+    Returns:
+        The same DataFrame
+    """
+    for column in df.select_dtypes(include="integer").columns:
+        df[column] = pd.to_numeric(df[column], downcast="integer")
+
+    return df
+
+
+def find_processed_file(data_dir: Path, file: str) -> Path:
+    """Pick the file to load a processed dataset from.
+
+    Parquet output from data_preparation.py, then the Parquet cache, is
+    preferred over the CSV unless the CSV has been written since.
+
+    Args:
+        data_dir: Directory containing the processed data files
+        file: Name of the processed CSV file
+
+    Returns:
+        Path to the file to load
+    """
+    csv_path = data_dir / file
+    csv_mtime = csv_path.stat().st_mtime if csv_path.exists() else None
+
+    for parquet_path in [
+        csv_path.with_suffix(".parquet"),
+        data_dir / f"{csv_path.stem}{PARQUET_CACHE_SUFFIX}",
+    ]:
+        if parquet_path.exists() and (
+            csv_mtime is None or parquet_path.stat().st_mtime >= csv_mtime
+        ):
+            return parquet_path
+
+    if csv_mtime is None:
+        raise FileNotFoundError(f"Required file {file} not found in {data_dir}")
+
+    return csv_path
+
+
+def write_parquet_cache(df: pd.DataFrame, csv_path: Path) -> None:
+    """Cache a parsed CSV as Parquet, if pyarrow is available.
+
+    Caching is best effort: if the cache can't be written, the CSV is just
+    parsed again next time.
+
+    Args:
+        df: Parsed contents of the CSV
+        csv_path: Path to the CSV file
+    """
+    if not PYARROW_AVAILABLE:
+        return
+
+    cache_path = csv_path.with_name(f"{csv_path.stem}{PARQUET_CACHE_SUFFIX}")
+    # Write to a temporary file first so an interrupted write never leaves a
+    # truncated cache that looks newer than the CSV
+    temp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+    try:
+        df.to_parquet(temp_path, index=False, compression="zstd")
+        temp_path.replace(cache_path)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+
+
+def read_processed_file(file_path: Path, file: str) -> pd.DataFrame:
+    """Read one processed data file, caching parsed CSVs as Parquet.
+
+    Args:
+        file_path: Path to a processed .parquet or .csv file
+        file: Name of the processed CSV file, which selects the schema
+
+    Returns:
+        DataFrame with the file's contents
+    """
+    schema = PROCESSED_SCHEMAS[file]
+    categoricals = {
+        column: dtype for column, dtype in schema["dtype"].items() if dtype == "category"
+    }
+
+    if file_path.suffix == ".parquet":
+        # Cast the numeric columns too: data_preparation.py stores med_code
+        # as a categorical of strings
+        numerics = {
+            column: dtype
+            for column, dtype in schema["dtype"].items()
+            if dtype not in ("category", "string")
+        }
+        df = pd.read_parquet(file_path, columns=schema["usecols"]).astype(
+            {**numerics, **categoricals}
+        )
+        # data_preparation.py writes every patient id as a category of every
+        # table; drop the ones this table doesn't use, as a CSV read would
+        for column in categoricals:
+            df[column] = df[column].cat.remove_unused_categories()
+    elif CSV_READ_OPTIONS["engine"] != "pyarrow":
+        df = pd.read_csv(file_path, **CSV_READ_OPTIONS, **schema)
+    else:
+        # pyarrow infers category values from the data (turning numeric codes
+        # into ints), so parse categoricals as strings and convert afterwards
+        df = pd.read_csv(
+            file_path,
+            **CSV_READ_OPTIONS,
+            usecols=schema["usecols"],
+            dtype={**schema["dtype"], **dict.fromkeys(categoricals, str)},
+        ).astype(categoricals)
+
+    # Values are printed to two decimals, which float32 can't always round
+    # the same way as float64, so only the integer columns are narrowed
+    df = downcast_integers(df)
+
+    if file_path.suffix == ".csv":
+        write_parquet_cache(df, file_path)
+
+    return df
+
+
 def load_processed_data(data_dir: Union[str, Path]) -> Dict[str, pd.DataFrame]:
     """Load the processed data files.
 
@@ -66,14 +287,23 @@ def load_processed_data(data_dir: Union[str, Path]) -> Dict[str, pd.DataFrame]:
         "medication_outcomes.csv",
     ]
 
-    dataset = {}
+    paths = []
     for file in required_files:
-        file_path = data_dir / file
-        if not file_path.exists():
-            raise FileNotFoundError(f"Required file {file} not found in {data_dir}")
-
-        print(f"Loading {file}...")
-        dataset[file.split(".")[0]] = pd.read_csv(file_path)
+        file_path = find_processed_file(data_dir, file)
+        print(f"Loading {file_path.name}...")
+        paths.append(file_path)
+
+    # The files are independent, and parsing mostly releases the GIL, so
+    # read them concurrently
+    with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        frames = executor.map(read_processed_file, paths, required_files)
+        dataset = {file.split(".")[0]: df for file, df in zip(required_files, frames)}
+
+    # Fill in missing medication reasons once, rather than per printed row
+    reasons = dataset["medications_diabetic"]["reasondescription"]
+    if "N/A" not in reasons.cat.categories:
+        reasons = reasons.cat.add_categories("N/A")
+    dataset["medications_diabetic"]["reasondescription"] = reasons.fillna("N/A")
 
     # Load summary
     summary_path = data_dir / "dataset_summary.json"
@@ -84,203 +314,448 @@ def load_processed_data(data_dir: Union[str, Path]) -> Dict[str, pd.DataFrame]:
     return dataset
 
 
-def format_data_for_llm(
-    dataset: Dict[str, pd.DataFrame], max_patients: int = 20, max_observations: int = 5
+def format_decimals(values: pd.Series) -> pd.Series:
+    """Format numbers to two decimal places.
+
+    Args:
+        values: Numbers to format
+
+    Returns:
+        Series of formatted strings with the same index
+    """
+    # astype keeps the result a string column even when values is empty,
+    # where map() would return it as float64
+    return values.map("{:.2f}".format).astype(str)
+
+
+def format_medication_summary(title: str, med_sums: pd.DataFrame) -> List[str]:
+    """Format per-medication outcome totals as a Markdown table.
+
+    Args:
+        title: Heading for the table
+        med_sums: Per-medication counts and sums of change and percent_change,
+            indexed by med_description
+
+    Returns:
+        Markdown pieces for the table section
+    """
+    mean_changes = med_sums["change_sum"] / med_sums["count"]
+    mean_pct_changes = med_sums["percent_change_sum"] / med_sums["percent_change_count"]
+
+    parts = [
+        f"## {title}\n\n",
+        "| Medication | Count | Mean Change | Mean % Change |\n",
+        "|------------|-------|-------------|---------------|\n",
+    ]
+    rows = (
+        "| "
+        + med_sums.index.to_series().astype(str)
+        + " | "
+        + med_sums["count"].astype(str)
+        + " | "
+        + format_decimals(mean_changes)
+        + " | "
+        + format_decimals(mean_pct_changes)
+        + "% |\n"
+    )
+    parts.append("".join(rows))
+    parts.append("\n")
+    return parts
+
+
+def format_timeline_rows(days: List[int], values: List[float], dates: List[str]) -> str:
+    """Format a series of observations as Markdown timeline table rows.
+
+    Args:
+        days: Days from medication start of each observation
+        values: Observed values
+        dates: Observation dates
+
+    Returns:
+        Table rows, one line per observation
+    """
+    return "".join(
+        [
+            f"| {day} | {value:.2f} | {date} |\n"
+            for day, value, date in zip(days, values, dates)
+        ]
+    )
+
+
+def format_patient_example(
+    patient_id: str,
+    patient_info: Tuple[str, str, str],
+    condition: Optional[Tuple[str, str]],
+    med_rows: List[Tuple[str, str, str]],
+    outcome_table: Optional[str],
+    timeline_series: List[Tuple[str, str, List[int], List[float], List[str]]],
 ) -> str:
-    """Format the processed data for LLM input.
+    """Format one patient's example section from its plain values.
+
+    Args:
+        patient_id: Patient identifier
+        patient_info: Gender, race and ethnicity
+        condition: Description and start date of the diabetes diagnosis, if any
+        med_rows: Start date, description and reason of each medication
+        outcome_table: Rows of the health outcomes table, if any
+        timeline_series: Medication description, observation description,
+            and days, values and dates of the observations to show, for each
+            timeline
+
+    Returns:
+        Markdown section for the patient
+    """
+    gender, race, ethnicity = patient_info
+
+    # Basic patient info
+    parts = [
+        f"## Patient: {patient_id[:8]}... (anonymized)\n\n",
+        f"- Gender: {gender}\n",
+        f"- Race: {race}\n",
+        f"- Ethnicity: {ethnicity}\n",
+    ]
+
+    if condition is not None:
+        description, start = condition
+        parts.append(f"- Diabetes Type: {description}\n")
+        parts.append(f"- Diagnosis Date: {start}\n\n")
+
+    if med_rows:
+        parts.append("### Medications\n\n")
+        parts.append("| Start Date | Medication | Reason |\n")
+        parts.append("|------------|------------|--------|\n")
+        for start, description, reason in med_rows:
+            parts.append(f"| {start} | {description} | {reason} |\n")
+        parts.append("\n")
+
+    if outcome_table is not None:
+        parts.append("### Health Outcomes\n\n")
+        parts.append("| Medication | Metric | Before | After | Change | % Change | Days Between |\n")
+        parts.append("|------------|--------|--------|-------|--------|----------|-------------|\n")
+        parts.append(outcome_table)
+        parts.append("\n")
+
+    for med_desc, obs_desc, days, values, dates in timeline_series:
+        parts.append(f"### Timeline: {med_desc} - {obs_desc}\n\n")
+        parts.append("| Days from Start | Value | Date |\n")
+        parts.append("|----------------|-------|------|\n")
+        parts.append(format_timeline_rows(days, values, dates))
+        parts.append("\n")
+
+    parts.append("---\n\n")
+    return "".join(parts)
+
+
+def iter_formatted_chunks(
+    dataset: Dict[str, pd.DataFrame], max_patients: int = 20, max_observations: int = 5
+) -> Iterator[str]:
+    """Format the processed data for LLM input, piece by piece.
+
+    Pieces are yielded as they're produced, so the output can be streamed to
+    disk without holding all of it in memory.
 
     Args:
         dataset: Dictionary of processed dataframes
         max_patients: Maximum number of patients to include
         max_observations: Maximum number of observations per patient to include
 
-    Returns:
-        Formatted data as a string
+    Yields:
+        Consecutive pieces of the formatted data
     """
     # Start with dataset summary
     if "summary" in dataset:
-        formatted_data = "# Dataset Summary\n\n"
-        formatted_data += json.dumps(dataset["summary"], indent=2) + "\n\n"
-    else:
-        formatted_data = ""
+        yield "# Dataset Summary\n\n"
+        yield json.dumps(dataset["summary"], indent=2) + "\n\n"
 
     # Add medication effectiveness summary
-    formatted_data += "# Medication Effectiveness Summary\n\n"
-
-    outcomes_df = dataset["medication_outcomes"]
+    yield "# Medication Effectiveness Summary\n\n"
+
+    # obs_code has only a handful of LOINC codes, so compare it as a categorical
+    outcomes_df = dataset["medication_outcomes"].astype({"obs_code": "category"})
+
+    # Aggregate HbA1c and glucose outcomes in one groupby pass. Sums and
+    # counts (rather than means) let the two glucose codes be pooled below.
+    hba1c_codes = ["4548-4"]
+    glucose_codes = ["2339-0", "2345-7"]
+    summary_outcomes = outcomes_df[outcomes_df["obs_code"].isin(hba1c_codes + glucose_codes)]
+    outcome_sums = summary_outcomes.groupby(
+        ["obs_code", "med_description"], observed=True
+    ).agg(
+        count=("change", "count"),
+        change_sum=("change", "sum"),
+        percent_change_count=("percent_change", "count"),
+        percent_change_sum=("percent_change", "sum"),
+    )
+    summary_codes = outcome_sums.index.get_level_values("obs_code")
 
     # Focus on HbA1c outcomes
-    hba1c_outcomes = outcomes_df[outcomes_df["obs_code"] == "4548-4"]
-    if not hba1c_outcomes.empty:
-        med_summary = (
-            hba1c_outcomes.groupby("med_description")
-            .agg({"change": ["mean", "count"], "percent_change": "mean"})
-            .reset_index()
+    if summary_codes.isin(hba1c_codes).any():
+        hba1c_sums = outcome_sums[summary_codes.isin(hba1c_codes)].groupby(
+            level="med_description", observed=True
+        ).sum()
+        yield from format_medication_summary(
+            "HbA1c Outcomes by Medication", hba1c_sums
         )
 
-        formatted_data += "## HbA1c Outcomes by Medication\n\n"
-        formatted_data += "| Medication | Count | Mean Change | Mean % Change |\n"
-        formatted_data += "|------------|-------|-------------|---------------|\n"
-
-        for _, row in med_summary.iterrows():
-            med_name = row["med_description"]
-            count = row[("change", "count")]
-            mean_change = row[("change", "mean")]
-            mean_pct_change = row[("percent_change", "mean")]
-
-            formatted_data += f"| {med_name} | {count} | {mean_change:.2f} | {mean_pct_change:.2f}% |\n"
-
-        formatted_data += "\n"
-
     # Add blood glucose outcomes
-    glucose_outcomes = outcomes_df[outcomes_df["obs_code"].isin(["2339-0", "2345-7"])]
-    if not glucose_outcomes.empty:
-        med_summary = (
-            glucose_outcomes.groupby("med_description")
-            .agg({"change": ["mean", "count"], "percent_change": "mean"})
-            .reset_index()
+    if summary_codes.isin(glucose_codes).any():
+        glucose_sums = outcome_sums[summary_codes.isin(glucose_codes)].groupby(
+            level="med_description", observed=True
+        ).sum()
+        yield from format_medication_summary(
+            "Blood Glucose Outcomes by Medication", glucose_sums
         )
 
-        formatted_data += "## Blood Glucose Outcomes by Medication\n\n"
-        formatted_data += "| Medication | Count | Mean Change | Mean % Change |\n"
-        formatted_data += "|------------|-------|-------------|---------------|\n"
+    # Select the patients with the most outcomes for detailed examples
+    selected_patients = (
+        outcomes_df.groupby("patient", observed=True)
+        .size()
+        .nlargest(max_patients)
+        .index.tolist()
+    )
 
-        for _, row in med_summary.iterrows():
-            med_name = row["med_description"]
-            count = row[("change", "count")]
-            mean_change = row[("change", "mean")]
-            mean_pct_change = row[("percent_change", "mean")]
+    # Look up the selected patients' demographics with one indexed lookup
+    patients_by_id = (
+        dataset["patients_diabetic"].drop_duplicates("patient").set_index("patient")
+    )
+    selected_patient_info = patients_by_id.loc[
+        selected_patients, ["gender", "race", "ethnicity"]
+    ]
 
-            formatted_data += f"| {med_name} | {count} | {mean_change:.2f} | {mean_pct_change:.2f}% |\n"
+    # Keep each patient's first diabetes diagnosis, indexed by patient
+    conditions = dataset["conditions_diabetic"]
+    diabetes_conditions = (
+        conditions[conditions["code"].isin(["44054006", "46635009"])]
+        .drop_duplicates("patient")
+        .set_index("patient")
+    )
 
-        formatted_data += "\n"
+    # Split medications by patient once, so the loop below looks patients up
+    # instead of scanning the table for every patient
+    meds_by_patient = dict(
+        list(dataset["medications_diabetic"].groupby("patient", sort=False, observed=True))
+    )
 
-    # Select a subset of patients for detailed examples
-    patient_outcomes = outcomes_df.groupby("patient").size().reset_index(name="count")
-    patient_outcomes = patient_outcomes.sort_values("count", ascending=False)
-    selected_patients = patient_outcomes.head(max_patients)["patient"].tolist()
+    # Build the selected patients' outcome table rows in one vectorized pass,
+    # then join them into one table body per patient
+    selected_outcomes = outcomes_df[outcomes_df["patient"].isin(selected_patients)]
+    outcome_rows = (
+        "| "
+        + selected_outcomes["med_description"].astype(str)
+        + " | "
+        + selected_outcomes["obs_description"].astype(str)
+        + " | "
+        + format_decimals(selected_outcomes["pre_value"])
+        + " | "
+        + format_decimals(selected_outcomes["post_value"])
+        + " | "
+        + format_decimals(selected_outcomes["change"])
+        + " | "
+        + format_decimals(selected_outcomes["percent_change"])
+        + "% | "
+        + selected_outcomes["days_between"].astype(str)
+        + " |\n"
+    )
+    outcome_tables_by_patient = outcome_rows.groupby(
+        selected_outcomes["patient"], sort=False, observed=True
+    ).agg("".join)
+
+    # Sort the selected patients' timelines once, so each (medication,
+    # observation) series is a run of rows already in days_relative order,
+    # and collect the row positions of each series by patient
+    timeline = dataset["observation_timeline"]
+    timeline = (
+        timeline[timeline["patient"].isin(selected_patients)]
+        .sort_values(
+            ["patient", "med_code", "obs_code", "days_relative"], kind="stable"
+        )
+        .reset_index(drop=True)
+    )
+    # (.indices isn't in row order for categorical keys, so order the runs
+    # by where they start)
+    series_indices = timeline.groupby(
+        ["patient", "med_code", "obs_code"], sort=False, observed=True
+    ).indices
+    timeline_series_by_patient = defaultdict(list)
+    for (patient_id, _, _), indices in sorted(
+        series_indices.items(), key=lambda item: item[1][0]
+    ):
+        timeline_series_by_patient[patient_id].append(indices)
+
+    # Pull the columns the timeline tables print out as plain arrays, so the
+    # loop below slices ndarrays rather than indexing DataFrames
+    (
+        timeline_med_descs,
+        timeline_obs_descs,
+        timeline_days,
+        timeline_values,
+        timeline_dates,
+    ) = (
+        timeline[column].to_numpy()
+        for column in [
+            "med_description",
+            "obs_description",
+            "days_relative",
+            "value",
+            "obs_date",
+        ]
+    )
 
     # Add patient examples
-    formatted_data += "# Patient Examples\n\n"
-
-    for patient_id in selected_patients:
-        patient_info = dataset["patients_diabetic"][
-            dataset["patients_diabetic"]["patient"] == patient_id
-        ].iloc[0]
-
-        # Basic patient info
-        formatted_data += f"## Patient: {patient_id[:8]}... (anonymized)\n\n"
-        formatted_data += f"- Gender: {patient_info['gender']}\n"
-        formatted_data += f"- Race: {patient_info['race']}\n"
-        formatted_data += f"- Ethnicity: {patient_info['ethnicity']}\n"
+    yield "# Patient Examples\n\n"
 
+    # Gather each selected patient's rows as plain values and format them
+    for patient_id, patient_info in zip(
+        selected_patients, selected_patient_info.itertuples(index=False, name=None)
+    ):
         # Get diabetes condition
-        diabetes_conditions = dataset["conditions_diabetic"][
-            (dataset["conditions_diabetic"]["patient"] == patient_id)
-            & (dataset["conditions_diabetic"]["code"].isin(["44054006", "46635009"]))
-        ]
-
-        if not diabetes_conditions.empty:
-            condition = diabetes_conditions.iloc[0]
-            formatted_data += f"- Diabetes Type: {condition['description']}\n"
-            formatted_data += f"- Diagnosis Date: {condition['start']}\n\n"
+        condition = None
+        if patient_id in diabetes_conditions.index:
+            diabetes_condition = diabetes_conditions.loc[patient_id]
+            condition = (diabetes_condition["description"], diabetes_condition["start"])
 
         # Get medications
-        patient_meds = dataset["medications_diabetic"][
-            dataset["medications_diabetic"]["patient"] == patient_id
-        ]
-
-        if not patient_meds.empty:
-            formatted_data += "### Medications\n\n"
-            formatted_data += "| Start Date | Medication | Reason |\n"
-            formatted_data += "|------------|------------|--------|\n"
-
-            for _, med in patient_meds.iterrows():
-                formatted_data += f"| {med['start']} | {med['description']} | {med.get('reasondescription', 'N/A')} |\n"
-
-            formatted_data += "\n"
+        med_rows = []
+        patient_meds = meds_by_patient.get(patient_id)
+        if patient_meds is not None:
+            med_rows = list(
+                patient_meds[["start", "description", "reasondescription"]].itertuples(
+                    index=False, name=None
+                )
+            )
+
+        # Get observation timeline (limited to max_observations), one
+        # series per medication and observation type
+        timeline_series = []
+        for indices in timeline_series_by_patient.get(patient_id, []):
+            # Select a subset of observations
+            if len(indices) > max_observations:
+                # Take first, last, and evenly spaced middle observations
+                indices = indices[
+                    np.linspace(0, len(indices) - 1, max_observations, dtype=np.intp)
+                ]
+
+            # Plain lists format faster than numpy scalars
+            timeline_series.append(
+                (
+                    timeline_med_descs[indices[0]],
+                    timeline_obs_descs[indices[0]],
+                    timeline_days[indices].tolist(),
+                    timeline_values[indices].tolist(),
+                    timeline_dates[indices].tolist(),
+                )
+            )
+
+        yield format_patient_example(
+            patient_id,
+            patient_info,
+            condition,
+            med_rows,
+            outcome_tables_by_patient.get(patient_id),
+            timeline_series,
+        )
 
-        # Get outcomes
-        patient_outcomes = dataset["medication_outcomes"][
-            dataset["medication_outcomes"]["patient"] == patient_id
-        ]
 
-        if not patient_outcomes.empty:
-            formatted_data += "### Health Outcomes\n\n"
-            formatted_data += "| Medication | Metric | Before | After | Change | % Change | Days Between |\n"
-            formatted_data += "|------------|--------|--------|-------|--------|----------|-------------|\n"
+def format_data_for_llm(
+    dataset: Dict[str, pd.DataFrame], max_patients: int = 20, max_observations: int = 5
+) -> str:
+    """Format the processed data for LLM input.
 
-            for _, outcome in patient_outcomes.iterrows():
-                med_desc = outcome["med_description"]
-                obs_desc = outcome["obs_description"]
-                pre_value = outcome["pre_value"]
-                post_value = outcome["post_value"]
-                change = outcome["change"]
-                pct_change = outcome["percent_change"]
-                days = outcome["days_between"]
+    Args:
+        dataset: Dictionary of processed dataframes
+        max_patients: Maximum number of patients to include
+        max_observations: Maximum number of observations per patient to include
 
-                formatted_data += f"| {med_desc} | {obs_desc} | {pre_value:.2f} | {post_value:.2f} | {change:.2f} | {pct_change:.2f}% | {days} |\n"
+    Returns:
+        Formatted data as a string
+    """
+    return "".join(
+        iter_formatted_chunks(
+            dataset, max_patients=max_patients, max_observations=max_observations
+        )
+    )
 
-            formatted_data += "\n"
 
-        # Get observation timeline (limited to max_observations)
-        patient_timeline = dataset["observation_timeline"][
-            dataset["observation_timeline"]["patient"] == patient_id
-        ]
+def join_in_batches(parts: Iterable[str], batch_size: int) -> Iterator[str]:
+    """Join string pieces into batches of at least batch_size characters.
 
-        if not patient_timeline.empty:
-            # Group by medication and observation type
-            for (med_code, obs_code), group in patient_timeline.groupby(
-                ["med_code", "obs_code"]
-            ):
-                # Get medication and observation descriptions
-                med_desc = group["med_description"].iloc[0]
-                obs_desc = group["obs_description"].iloc[0]
+    Args:
+        parts: String pieces to join
+        batch_size: Minimum length of each batch but the last
 
-                # Sort by days_relative
-                group = group.sort_values("days_relative")
+    Yields:
+        Non-empty batches of consecutive pieces
+    """
+    batch: List[str] = []
+    size = 0
+    for part in parts:
+        batch.append(part)
+        size += len(part)
+        if size >= batch_size:
+            yield "".join(batch)
+            batch = []
+            size = 0
 
-                # Select a subset of observations
-                if len(group) > max_observations:
-                    # Take first, last, and evenly spaced middle observations
-                    indices = np.linspace(
-                        0, len(group) - 1, max_observations, dtype=int
-                    )
-                    group = group.iloc[indices]
+    if size:
+        yield "".join(batch)
 
-                formatted_data += f"### Timeline: {med_desc} - {obs_desc}\n\n"
-                formatted_data += "| Days from Start | Value | Date |\n"
-                formatted_data += "|----------------|-------|------|\n"
 
-                for _, row in group.iterrows():
-                    days = row["days_relative"]
-                    value = row["value"]
-                    date = row["obs_date"]
+def count_tokens(text: str, follows_whitespace: bool = True) -> int:
+    """Count whitespace-separated tokens, like len(text.split()).
 
-                    formatted_data += f"| {days} | {value:.2f} | {date} |\n"
+    Counts the places where non-whitespace follows whitespace in one numpy
+    pass, instead of building a list of every token. Only ASCII whitespace
+    separates tokens.
 
-                formatted_data += "\n"
+    Args:
+        text: Text to count tokens in
+        follows_whitespace: Whether text comes after whitespace (or starts the
+            data), so that a token at its start is counted
 
-        formatted_data += "---\n\n"
+    Returns:
+        Number of tokens that start in text
+    """
+    data = np.frombuffer(text.encode(), dtype=np.uint8)
+    if not data.size:
+        return 0
 
-    return formatted_data
+    is_space = ASCII_WHITESPACE[data]
+    token_starts = ~is_space
+    token_starts[1:] &= is_space[:-1]
+    token_starts[0] &= follows_whitespace
+    return int(np.count_nonzero(token_starts))
 
 
-def save_formatted_data(formatted_data: str, output_file: Union[str, Path]) -> None:
+def save_formatted_data(
+    formatted_data: Union[str, Iterable[str]], output_file: Union[str, Path]
+) -> None:
     """Save formatted data to a file.
 
     Args:
-        formatted_data: Formatted data as a string
+        formatted_data: Formatted data as a string or an iterable of string pieces
         output_file: File to save formatted data
     """
     output_file = Path(output_file)
     output_file.parent.mkdir(parents=True, exist_ok=True)
 
-    with open(output_file, "w") as f:
-        f.write(formatted_data)
+    if isinstance(formatted_data, str):
+        formatted_data = [formatted_data]
+
+    # Write pieces in large batches as they're produced, counting tokens
+    # along the way instead of keeping the whole output around
+    token_count = 0
+    follows_whitespace = True
+    with open(output_file, "w", buffering=WRITE_BUFFER_SIZE) as f:
+        for batch in join_in_batches(formatted_data, WRITE_BUFFER_SIZE):
+            f.write(batch)
+            token_count += count_tokens(batch, follows_whitespace)
+            # Carry over whether the batch ended in a separator, by the same
+            # ASCII-only rule count_tokens uses
+            last_char = ord(batch[-1])
+            follows_whitespace = last_char < 128 and bool(ASCII_WHITESPACE[last_char])
 
     print(f"Formatted data saved to {output_file}")
-    print(f"Approximate token count: {len(formatted_data.split())}")
+    print(f"Approximate token count: {token_count}")
 
 
 def main(args: argparse.Namespace) -> None:
@@ -292,13 +767,11 @@ def main(args: argparse.Namespace) -> None:
     # Load processed data
     dataset = load_processed_data(args.data_dir)
 
-    # Format data for LLM
-    formatted_data = format_data_for_llm(
+    # Format data for LLM, streaming it straight to the output file
+    formatted_chunks = iter_formatted_chunks(
         dataset, max_patients=args.max_patients, max_observations=args.max_observations
     )
-
-    # Save formatted data
-    save_formatted_data(formatted_data, args.output_file)
+    save_formatted_data(formatted_chunks, args.output_file)
 
 
 if __name__ == "__main__":